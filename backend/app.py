@@ -2,21 +2,43 @@ import os
 import secrets
 import csv
 import io
+import gzip
+import json
+import glob
+import random
+import time
+import queue
+import atexit
+import threading
+import cProfile
+import pstats
+import re
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from functools import wraps
 from datetime import datetime, timedelta
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, has_app_context, has_request_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn, CreateIndex
 from flask_jwt_extended import (
     JWTManager,
     create_access_token,
     jwt_required,
     get_jwt_identity,
+    verify_jwt_in_request,
 )
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from dotenv import load_dotenv
 import mercadopago
 
@@ -25,14 +47,34 @@ load_dotenv()
 app = Flask(__name__)
 
 # Token encryption for Mercado Pago credentials
-encryption_key = os.getenv("ENCRYPTION_KEY") or None
-
-if not encryption_key:
+# ENCRYPTION_KEYS="<version>:<key>,..." (any order) enables rotation: new tokens
+# use the highest version, any listed key decrypts. ENCRYPTION_KEY alone = version 1.
+def parse_encryption_keys(raw: str) -> dict:
+    keys = {}
+    for entry in raw.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        version, _, key = entry.partition(":")
+        keys[int(version)] = key.strip()
+    return keys
+
+
+encryption_keys = parse_encryption_keys(os.getenv("ENCRYPTION_KEYS") or "")
+if not encryption_keys and os.getenv("ENCRYPTION_KEY"):
+    encryption_keys = {1: os.getenv("ENCRYPTION_KEY")}
+
+encryption_key_is_ephemeral = not encryption_keys
+if encryption_key_is_ephemeral:
     print("⚠️  ENCRYPTION_KEY não configurada. Gerando nova chave...")
-    encryption_key = Fernet.generate_key().decode()
-    print(f"⚠️  Adicione ao .env: ENCRYPTION_KEY={encryption_key}")
+    encryption_keys = {1: Fernet.generate_key().decode()}
+    print(f"⚠️  Adicione ao .env: ENCRYPTION_KEY={encryption_keys[1]}")
+    print("⚠️  Tokens salvos com esta chave ficam ilegíveis no próximo restart")
 
-cipher = Fernet(encryption_key.encode() if isinstance(encryption_key, str) else encryption_key)
+CURRENT_KEY_VERSION = max(encryption_keys)
+cipher = MultiFernet(
+    [Fernet(encryption_keys[v].encode()) for v in sorted(encryption_keys, reverse=True)]
+)
 
 
 def encrypt_mp_token(token: str) -> str:
@@ -53,12 +95,15 @@ CORS(
     app,
     resources={r"/api/*": {"origins": allowed_origins}},
     supports_credentials=True,
-    allow_headers=["Content-Type", "Authorization"]
+    allow_headers=["Content-Type", "Authorization", "X-PixFlow-Sticky-Until", "X-PixFlow-Profile"],
+    expose_headers=["X-PixFlow-Sticky-Until", "X-PixFlow-Profile-Id"],
 )
 
 # Database: PostgreSQL in production, SQLite locally
 db_url = os.getenv("DATABASE_URL") or "sqlite:///pixflow.db"
 
+db_is_postgres = db_url.startswith(("postgres://", "postgresql"))
+
 if "sqlite" in db_url:
     print("⚠️  SQLite detected - use PostgreSQL in production")
 else:
@@ -67,10 +112,68 @@ else:
 app.config["SQLALCHEMY_DATABASE_URI"] = db_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Optional read replicas (comma-separated URLs), each exposed as bind "replica_N"
+replica_urls = [u.strip() for u in (os.getenv("DATABASE_REPLICA_URLS") or "").split(",") if u.strip()]
+REPLICA_BINDS = [f"replica_{i}" for i in range(len(replica_urls))]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS") or 5)
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS") or 10)
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS") or 10)
+# Health checks run inside requests: an unreachable replica must fail fast,
+# well before gunicorn's 30s worker timeout
+REPLICA_CONNECT_TIMEOUT_SECONDS = int(os.getenv("REPLICA_CONNECT_TIMEOUT_SECONDS") or 2)
+REPLICA_STATEMENT_TIMEOUT_MS = int(os.getenv("REPLICA_STATEMENT_TIMEOUT_MS") or 10000)
+
+
+def replica_bind_config(url: str):
+    if not url.startswith(("postgres://", "postgresql")):
+        return url
+    return {
+        "url": url,
+        "connect_args": {
+            "connect_timeout": REPLICA_CONNECT_TIMEOUT_SECONDS,
+            "options": f"-c statement_timeout={REPLICA_STATEMENT_TIMEOUT_MS}",
+        },
+    }
+
+
+# Optional tenant shards (comma-separated URLs), each exposed as bind "shard_N".
+# Tenants without a TenantShard row keep their charges in the main database.
+shard_urls = [u.strip() for u in (os.getenv("DATABASE_SHARD_URLS") or "").split(",") if u.strip()]
+SHARD_BINDS = [f"shard_{i}" for i in range(len(shard_urls))]
+SHARDED_TABLES = {"charge", "client_stat", "client_ticket_bucket", "client_summary"}
+
+app.config["SQLALCHEMY_BINDS"] = {
+    **{bind: replica_bind_config(url) for bind, url in zip(REPLICA_BINDS, replica_urls)},
+    **dict(zip(SHARD_BINDS, shard_urls)),
+}
+
+if replica_urls:
+    print(f"✅ {len(replica_urls)} read replica(s) configured")
+if shard_urls:
+    print(f"✅ {len(shard_urls)} tenant shard(s) configured")
+
 jwt_secret = os.getenv("JWT_SECRET") or "devsecret"
 app.config["JWT_SECRET_KEY"] = jwt_secret
 
-db = SQLAlchemy(app)
+
+class RoutingSession(FlaskSQLAlchemySession):
+    # Tenant tables (SHARDED_TABLES) go to the current tenant's shard.
+    # Other reads go to the replica picked in before_request (g.db_bind);
+    # other flushes always go to the default bind.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            if SHARD_BINDS and mapper is not None and db.inspect(mapper).local_table.name in SHARDED_TABLES:
+                tenant_bind = current_tenant_bind()
+                if tenant_bind is not None:
+                    return self._db.engines[tenant_bind]
+
+            bind_key = g.get("db_bind")
+            if bind_key is not None and not self._flushing:
+                return self._db.engines[bind_key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={"class_": RoutingSession})
 jwt = JWTManager(app)
 
 # Rate limiting (global: 200/day, 50/hour)
@@ -94,6 +197,7 @@ class User(db.Model):
 
     pix = db.Column(db.String(255), nullable=True)
     mp_token_encrypted = db.Column(db.Text, nullable=True)  # Encrypted Mercado Pago token
+    mp_token_key_version = db.Column(db.Integer, nullable=True)  # ENCRYPTION_KEYS version used
 
     role = db.Column(db.String(50), default="user")
     active = db.Column(db.Boolean, default=True)
@@ -101,17 +205,114 @@ class User(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Keyset pagination for the admin directory (created_at desc, id desc)
+        db.Index("ix_user_created_at_id", "created_at", "id"),
+        # Prefix search (LIKE 'abc%'); text_pattern_ops lets PostgreSQL use the btree
+        db.Index("ix_user_email_prefix", "email", postgresql_ops={"email": "text_pattern_ops"}),
+    )
+
 
 class Charge(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    # On PostgreSQL the table is range-partitioned by month on created_at, so the
+    # partition key must be part of the table's primary key. The mapper still
+    # identifies rows by id alone (Charge.query.get(id) keeps working).
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, nullable=False)  # dono (multi-tenant)
 
     client = db.Column(db.String(255), nullable=False)
     value = db.Column(db.String(50), nullable=False)
     message = db.Column(db.Text, nullable=True)
 
-    status = db.Column(db.String(50), default="pending")  # pending/paid/canceled
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    status = db.Column(db.String(50), default="pending")  # see CHARGE_TRANSITIONS
+    version = db.Column(db.Integer, default=1, server_default="1", nullable=False)  # bumped on every status write
+    refund_claimed_at = db.Column(db.DateTime, nullable=True)  # set while status is "refunding"
+    created_at = db.Column(
+        db.DateTime, default=datetime.utcnow, nullable=False, primary_key=db_is_postgres
+    )
+
+    __table_args__ = (
+        # Every tenant query filters by owner and a created_at window
+        db.Index("ix_charge_user_created", "user_id", "created_at"),
+        # Archival walks whole months
+        db.Index("ix_charge_created_at", "created_at"),
+        {"postgresql_partition_by": "RANGE (created_at)"} if db_is_postgres else {},
+    )
+    __mapper_args__ = {"primary_key": [id]}
+
+
+db.Index(
+    "ix_user_name_prefix",
+    db.func.lower(User.name).label("lower_name"),
+    postgresql_ops={"lower_name": "text_pattern_ops"},
+)
+
+
+# Allowed status changes; anything else is rejected before touching the row
+CHARGE_TRANSITIONS = {
+    "pending": {"paid", "approved", "canceled"},
+    "paid": {"pending"},  # manual PIX confirmation can be undone
+    "approved": {"refunding"},  # Mercado Pago payment: refund only
+    "refunding": {"refunded", "approved"},  # claimed before calling MP; back to approved if it fails
+    "canceled": {"pending"},
+    "refunded": set(),
+}
+# A "refunding" claim older than this was left by a dead worker and may be retried
+REFUND_CLAIM_TIMEOUT_SECONDS = int(os.getenv("REFUND_CLAIM_TIMEOUT_SECONDS") or 120)
+
+
+# CLIENT ANALYTICS (maintained on every charge write, never recomputed per request)
+class ClientStat(db.Model):
+    # One row per (tenant, client); client_key is the normalized client name
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    client_key = db.Column(db.String(255), primary_key=True)
+    client = db.Column(db.String(255), nullable=False)  # last spelling seen
+
+    charge_count = db.Column(db.Integer, nullable=False, default=0)
+    paid_count = db.Column(db.Integer, nullable=False, default=0)
+    paid_total = db.Column(db.Float, nullable=False, default=0.0)
+
+    first_seen_at = db.Column(db.DateTime, nullable=False)
+    last_seen_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # Top-N per tenant are index scans
+        db.Index("ix_client_stat_revenue", "user_id", "paid_total"),
+        db.Index("ix_client_stat_count", "user_id", "charge_count"),
+        db.Index("ix_client_stat_recent", "user_id", "last_seen_at"),
+    )
+
+
+class ClientTicketBucket(db.Model):
+    # Per-tenant histogram of paid ticket sizes (see TICKET_BUCKET_EDGES)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class ClientSummary(db.Model):
+    # Per-tenant totals, so repeat-customer rate is a single-row read
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    clients = db.Column(db.Integer, nullable=False, default=0)
+    paying_clients = db.Column(db.Integer, nullable=False, default=0)
+    repeat_clients = db.Column(db.Integer, nullable=False, default=0)  # 2+ paid charges
+    charge_count = db.Column(db.Integer, nullable=False, default=0)
+    paid_count = db.Column(db.Integer, nullable=False, default=0)
+    paid_total = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class TenantShard(db.Model):
+    # Shard map: which bind holds a tenant's charges (NULL = main database)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bind = db.Column(db.String(50), nullable=True)
+    moving = db.Column(db.Boolean, default=False, nullable=False)  # writes frozen during cutover
+
+
+class IdAllocator(db.Model):
+    # Global id sequences for sharded tables, so rows keep their id when moved
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False)
 
 
 class ResetToken(db.Model):
@@ -123,6 +324,23 @@ class ResetToken(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class AuditEvent(db.Model):
+    # Append-only; written in batches by audit_writer, never updated
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    actor_id = db.Column(db.Integer, nullable=True)  # None = anonymous (e.g. failed login)
+    action = db.Column(db.String(50), nullable=False)
+    target_type = db.Column(db.String(50), nullable=True)
+    target_id = db.Column(db.Integer, nullable=True)
+    ip = db.Column(db.String(64), nullable=True)
+    details = db.Column(db.Text, nullable=True)  # JSON
+
+    __table_args__ = (
+        db.Index("ix_audit_event_created_id", "created_at", "id"),
+    )
+
+
 def normalize_email(email: str) -> str:
     return (email or "").strip().lower()
 
@@ -143,14 +361,960 @@ def require_admin():
     return u
 
 
+def like_prefix(term: str) -> str:
+    """LIKE pattern matching values that start with `term` (wildcards escaped)."""
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def charge_value_number():
+    """Charge.value as a SQL number; non-numeric values count as 0."""
+    value = db.cast(Charge.value, db.Float)
+    if db.engine.dialect.name == "postgresql":
+        # PostgreSQL refuses to cast free text, SQLite silently yields 0
+        return db.case((Charge.value.op("~")(r"^\s*[0-9]+(\.[0-9]+)?\s*$"), value), else_=0.0)
+    return value
+
+
+# PROFILING (opt-in)
+# With PROFILING_ENABLED unset nothing below is hooked in. When enabled, a
+# request is profiled if an admin sends "X-PixFlow-Profile: 1" or it falls in
+# PROFILE_SAMPLE_RATE. Each profile (cProfile stats + SQL timings) is kept in
+# PROFILE_DIR, which holds at most PROFILE_MAX_FILES profiles (oldest removed).
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "").lower() in ("1", "true")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES") or 100)
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PROFILE_ID_RE = re.compile(r"^[0-9]+-[0-9]+-[0-9a-f]+$")
+
+
+def profile_requested_by_admin() -> bool:
+    if request.headers.get("X-PixFlow-Profile") != "1":
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return False
+    return require_admin() is not None
+
+
+def start_request_profile():
+    if not (profile_requested_by_admin() or random.random() < PROFILE_SAMPLE_RATE):
+        return
+    g.profile_sql = []
+    g.profile_started_at = datetime.utcnow()
+    g.profile_t0 = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def finish_request_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    duration_ms = (time.perf_counter() - g.profile_t0) * 1000
+
+    profile_id = f"{int(time.time() * 1000)}-{os.getpid()}-{secrets.token_hex(3)}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+    sql = g.pop("profile_sql", [])
+    meta = {
+        "id": profile_id,
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "started_at": g.profile_started_at.isoformat(),
+        "duration_ms": round(duration_ms, 2),
+        "sql_count": len(sql),
+        "sql_ms": round(sum(q["duration_ms"] for q in sql), 2),
+        "sql": sql,
+        "stats": out.getvalue(),
+    }
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    # Ring buffer: ids start with a millisecond timestamp, so names sort by age
+    profiles = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")))
+    for path in profiles[:-PROFILE_MAX_FILES]:
+        for stale in (path, path[: -len(".json")] + ".prof"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+    response.headers["X-PixFlow-Profile-Id"] = profile_id
+    return response
+
+
+def stop_request_profile(exc=None):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+
+
+# The start time lives on the statement's execution context, not the pooled
+# connection: a failing statement never reaches after_cursor_execute.
+def record_sql_start(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and "profile_sql" in g:
+        context.profile_t0 = time.perf_counter()
+
+
+def record_sql_end(conn, cursor, statement, parameters, context, executemany):
+    t0 = getattr(context, "profile_t0", None)
+    if t0 is not None and has_request_context() and "profile_sql" in g:
+        g.profile_sql.append({
+            "statement": statement[:500],
+            "duration_ms": round((time.perf_counter() - t0) * 1000, 3),
+            "database": conn.engine.url.database,
+        })
+
+
+# Registered before the replica/tenant hooks so their time is profiled too
+if PROFILING_ENABLED:
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(stop_request_profile)
+    db.event.listen(Engine, "before_cursor_execute", record_sql_start)
+    db.event.listen(Engine, "after_cursor_execute", record_sql_end)
+    print(f"✅ Profiling habilitado (amostragem {PROFILE_SAMPLE_RATE:.0%})")
+
+
+# READ REPLICA ROUTING
+# Endpoints marked @replica_read are served by a healthy replica unless the
+# client wrote recently: after a committing request the response carries
+# X-PixFlow-Sticky-Until and the client echoes it back (works across workers).
+REPLICA_READ_ENDPOINTS = set()
+replica_health = {}  # bind -> (checked_at, healthy)
+
+
+def replica_read(f):
+    REPLICA_READ_ENDPOINTS.add(f.__name__)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        bind = g.get("db_bind")
+        if bind is None:
+            return f(*args, **kwargs)
+        try:
+            return f(*args, **kwargs)
+        except db.exc.DBAPIError as e:
+            # Replica died mid-request: take it out of rotation and serve the
+            # (read-only) endpoint again from the primary.
+            print(f"⚠️  Réplica {bind} falhou, repetindo no primário: {e}")
+            replica_health[bind] = (time.monotonic(), False)
+            db.session.rollback()
+            g.pop("db_bind", None)
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+def replica_lag_seconds(engine) -> float:
+    with engine.connect() as conn:
+        if engine.dialect.name != "postgresql":
+            # No replication to lag behind, but a dead replica must still fail here
+            conn.execute(db.text("SELECT 1"))
+            return 0.0
+        return float(
+            conn.execute(
+                db.text(
+                    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+                )
+            ).scalar()
+            or 0
+        )
+
+
+def replica_is_healthy(bind: str) -> bool:
+    checked_at, healthy = replica_health.get(bind, (0.0, False))
+    now = time.monotonic()
+    if now - checked_at < REPLICA_LAG_CHECK_SECONDS:
+        return healthy
+
+    try:
+        healthy = replica_lag_seconds(db.engines[bind]) <= REPLICA_MAX_LAG_SECONDS
+    except Exception as e:
+        print(f"⚠️  Réplica {bind} indisponível: {e}")
+        healthy = False
+
+    replica_health[bind] = (now, healthy)
+    return healthy
+
+
+def client_is_sticky() -> bool:
+    try:
+        sticky_until = float(request.headers.get("X-PixFlow-Sticky-Until") or 0)
+    except ValueError:
+        return False
+    return sticky_until > time.time()
+
+
+@app.before_request
+def route_reads_to_replica():
+    if not REPLICA_BINDS or request.endpoint not in REPLICA_READ_ENDPOINTS:
+        return
+    if client_is_sticky():
+        return
+
+    healthy = [b for b in REPLICA_BINDS if replica_is_healthy(b)]
+    if healthy:
+        g.db_bind = random.choice(healthy)
+
+
+@db.event.listens_for(RoutingSession, "after_commit")
+def remember_commit(session):
+    if has_request_context():
+        g.db_committed = True
+
+
+@app.after_request
+def mark_sticky_after_write(response):
+    if g.get("db_committed") and response.status_code < 400:
+        response.headers["X-PixFlow-Sticky-Until"] = f"{time.time() + REPLICA_STICKY_SECONDS:.3f}"
+    return response
+
+
+# TENANT SHARDING
+# A tenant's bind comes from the shard map on the main database; requests
+# resolve it lazily from the JWT identity, maintenance code pins it with
+# tenant_bind_for(). Moves freeze writes (TenantShard.moving) only for cutover.
+def tenant_shard_row(user_id: int):
+    with db.engine.connect() as conn:
+        return conn.execute(
+            db.select(TenantShard.bind, TenantShard.moving).where(TenantShard.user_id == user_id)
+        ).first()
+
+
+def current_tenant_bind():
+    if "tenant_bind" in g:
+        return g.tenant_bind
+    if not has_request_context():
+        return None
+    try:
+        uid = get_jwt_identity()
+    except RuntimeError:  # JWT not verified (yet)
+        return None
+    if not uid:
+        return None
+
+    row = tenant_shard_row(int(uid))
+    g.tenant_bind = row.bind if row else None
+    g.tenant_moving = bool(row and row.moving)
+    return g.tenant_bind
+
+
+@contextmanager
+def tenant_bind_for(user_id: int):
+    missing = object()
+    previous = g.get("tenant_bind", missing)
+    row = tenant_shard_row(user_id)
+    g.tenant_bind = row.bind if row else None
+    try:
+        yield g.tenant_bind
+    finally:
+        if previous is missing:
+            g.pop("tenant_bind", None)
+        else:
+            g.tenant_bind = previous
+
+
+def tenant_binds(user_ids: list) -> dict:
+    # user_id -> bind for a batch of tenants, one query
+    if not SHARD_BINDS:
+        return {uid: None for uid in user_ids}
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            db.select(TenantShard.user_id, TenantShard.bind).where(TenantShard.user_id.in_(user_ids))
+        ).all()
+    binds = dict(rows)
+    return {uid: binds.get(uid) for uid in user_ids}
+
+
+def assign_tenant_shard(user_id: int):
+    if not SHARD_BINDS:
+        return None
+    counts = dict(
+        db.session.query(TenantShard.bind, db.func.count(TenantShard.user_id))
+        .group_by(TenantShard.bind)
+        .all()
+    )
+    bind = min(SHARD_BINDS, key=lambda b: counts.get(b, 0))
+    db.session.add(TenantShard(user_id=user_id, bind=bind))
+    return bind
+
+
+def charge_engine(bind):
+    # Main database reads follow the request's replica choice
+    return db.engines[bind if bind is not None else g.get("db_bind")]
+
+
+def run_on_binds(statements: dict) -> dict:
+    # Executes {bind: statement} concurrently, one connection per bind
+    engines = {bind: charge_engine(bind) for bind in statements}
+
+    def run(bind):
+        with engines[bind].connect() as conn:
+            return conn.execute(statements[bind]).all()
+
+    # Workers run in a copy of the request's context, so the SQL profiler
+    # still attributes their queries to this request
+    context = copy_context()
+    with ThreadPoolExecutor(max_workers=len(statements) or 1) as pool:
+        return dict(zip(statements, pool.map(lambda bind: context.copy().run(run, bind), statements)))
+
+
+def allocate_id(name: str) -> int:
+    if db.engine.dialect.name == "postgresql":
+        # nextval() is not transactional, so tenants never queue on a shared row
+        with db.engine.connect() as conn:
+            return conn.execute(db.text(f"SELECT nextval('{name}_global_id_seq')")).scalar()
+
+    table = IdAllocator.__table__
+    with db.engine.begin() as conn:
+        return conn.execute(
+            db.update(table)
+            .where(table.c.name == name)
+            .values(next_value=table.c.next_value + 1)
+            .returning(table.c.next_value)
+        ).scalar() - 1
+
+
+def init_id_allocator(name: str, table) -> None:
+    # Run under schema_lock: starts the allocator past every id already in use
+    with db.engine.begin() as conn:
+        allocated = conn.execute(
+            db.select(IdAllocator.next_value).where(IdAllocator.name == name)
+        ).scalar()
+        if allocated is not None and conn.dialect.name != "postgresql":
+            return
+        highest = (allocated or 1) - 1
+        for engine in [db.engine] + [db.engines[b] for b in SHARD_BINDS]:
+            with engine.connect() as shard_conn:
+                highest = max(highest, shard_conn.execute(db.select(db.func.max(table.c.id))).scalar() or 0)
+
+        if conn.dialect.name == "postgresql":
+            sequence = f"{name}_global_id_seq"
+            conn.execute(db.text(f"CREATE SEQUENCE IF NOT EXISTS {sequence}"))
+            conn.execute(
+                db.text(
+                    f"SELECT setval('{sequence}', :highest) FROM {sequence} "
+                    "WHERE :highest > CASE WHEN is_called THEN last_value ELSE last_value - 1 END"
+                ),
+                {"highest": highest},
+            )
+        else:
+            try:
+                conn.execute(db.insert(IdAllocator.__table__).values(name=name, next_value=highest + 1))
+            except db.exc.IntegrityError:
+                pass  # another worker initialized it first
+
+
+@db.event.listens_for(Charge, "before_insert")
+def assign_global_charge_id(mapper, connection, target):
+    if SHARD_BINDS and target.id is None:
+        target.id = allocate_id("charge")
+
+
+@app.before_request
+def block_writes_during_tenant_move():
+    if not SHARD_BINDS or request.method in ("GET", "HEAD", "OPTIONS"):
+        return None
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return None  # the view's @jwt_required answers
+    current_tenant_bind()
+    if g.get("tenant_moving"):
+        return jsonify({"error": "Conta em migração, tente novamente em instantes"}), 503
+    return None
+
+
+def charge_to_json(r: Charge) -> dict:
+    return {
+        "id": r.id,
+        "client": r.client,
+        "value": r.value,
+        "message": r.message,
+        "status": r.status,
+        "version": r.version,
+        "allowed_transitions": sorted(CHARGE_TRANSITIONS.get(r.status, ())),
+        "created_at": r.created_at.isoformat(),
+    }
+
+
+def transition_charge(charge: Charge, new_status: str, expected_version: int, **values) -> bool:
+    # Compare-and-swap: UPDATE ... WHERE id=? AND version=?; no row locks.
+    # False means another writer changed the charge first.
+    result = db.session.execute(
+        db.update(Charge)
+        .where(Charge.id == charge.id, Charge.version == expected_version)
+        .values(status=new_status, version=Charge.version + 1, **values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def charge_conflict(charge: Charge):
+    db.session.rollback()
+    db.session.refresh(charge)
+    return jsonify({
+        "error": "Cobrança alterada por outra requisição",
+        "current": charge_to_json(charge),
+    }), 409
+
+
+def add_missing_columns(engine, table) -> None:
+    # create_all() never alters existing tables; new columns need a server_default
+    existing = {c["name"] for c in db.inspect(engine).get_columns(table.name)}
+    missing = [c for c in table.columns if c.name not in existing]
+    if not missing:
+        return
+    # Quoted names: "user" is a reserved word on PostgreSQL.
+    # CreateColumn quotes the column name through the same preparer.
+    table_name = engine.dialect.identifier_preparer.format_table(table)
+    with engine.begin() as conn:
+        for column in missing:
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            conn.execute(db.text(f"ALTER TABLE {table_name} ADD COLUMN {ddl}"))
+
+
+def add_missing_indexes(engine, table) -> None:
+    # create_all() skips tables that already exist, and their new indexes with them.
+    # IF NOT EXISTS instead of checkfirst: reflecting expression indexes warns on SQLite.
+    with engine.begin() as conn:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+@contextmanager
+def schema_lock(engine):
+    # Serializes startup DDL across gunicorn workers (PostgreSQL advisory lock)
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as conn:
+        conn.execute(db.text("SELECT pg_advisory_lock(hashtext('pixflow_schema'))"))
+        try:
+            yield
+        finally:
+            conn.execute(db.text("SELECT pg_advisory_unlock(hashtext('pixflow_schema'))"))
+            conn.commit()
+
+
+def parse_keyset_cursor(cursor: str):
+    # "<created_at iso>|<id>" of the last row on the previous page
+    ts_str, id_str = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(ts_str), int(id_str)
+
+
+def keyset_cursor(row) -> str:
+    return f"{row.created_at.isoformat()}|{row.id}"
+
+
+def keyset_before(model, ts: datetime, last_id: int):
+    # Rows after the cursor in (created_at desc, id desc) order
+    return db.or_(
+        model.created_at < ts,
+        db.and_(model.created_at == ts, model.id < last_id),
+    )
+
+
+# AUDIT LOG (write-behind)
+# Requests only enqueue a dict; one thread per worker process inserts them in
+# batches of AUDIT_BATCH_SIZE or every AUDIT_FLUSH_SECONDS. A full queue makes
+# producers wait up to AUDIT_PUT_TIMEOUT seconds, then the event is dropped.
+class AuditWriter:
+    _stop = object()
+
+    def __init__(self, maxsize: int, batch_size: int, flush_seconds: float, put_timeout: float):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def record(self, event: dict) -> None:
+        self._ensure_thread()
+        try:
+            self.queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        # Flushes what is queued and stops the thread (atexit / tests)
+        if self._running():
+            self.queue.put(self._stop)
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _running(self) -> bool:
+        # Threads do not survive gunicorn's fork; restart per worker pid
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_thread(self) -> None:
+        if self._running():
+            return
+        with self._lock:
+            if self._running():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0.001))
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stopping = True
+                    break
+                batch.append(item)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        try:
+            with app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(db.insert(AuditEvent.__table__), batch)
+        except Exception as e:
+            print(f"⚠️  Falha ao gravar {len(batch)} evento(s) de auditoria: {e}")
+
+
+audit_writer = AuditWriter(
+    maxsize=int(os.getenv("AUDIT_QUEUE_SIZE") or 10000),
+    batch_size=int(os.getenv("AUDIT_BATCH_SIZE") or 200),
+    flush_seconds=float(os.getenv("AUDIT_FLUSH_SECONDS") or 2),
+    put_timeout=float(os.getenv("AUDIT_PUT_TIMEOUT") or 0.05),
+)
+atexit.register(audit_writer.close)
+
+
+def audit(action: str, target_type: str = None, target_id: int = None, actor_id: int = None, **details) -> None:
+    if actor_id is None:
+        try:
+            identity = get_jwt_identity()
+            actor_id = int(identity) if identity else None
+        except RuntimeError:  # no verified JWT in this request
+            pass
+    audit_writer.record({
+        "created_at": datetime.utcnow(),
+        "actor_id": actor_id,
+        "action": action,
+        "target_type": target_type,
+        "target_id": target_id,
+        "ip": request.remote_addr if has_request_context() else None,
+        "details": json.dumps(details) if details else None,
+    })
+
+
+REVENUE_STATUSES = ("approved", "paid", "refunding")  # refunding: money still held until MP confirms
+TICKET_BUCKET_EDGES = [10, 25, 50, 100, 250, 500, 1000]  # bucket i = [edge[i-1], edge[i])
+CLIENT_STAT_TABLES = [ClientStat, ClientTicketBucket, ClientSummary]
+
+
+def client_key(client: str) -> str:
+    return " ".join((client or "").lower().split())[:255]
+
+
+def charge_amount(value: str) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def ticket_bucket(amount: float) -> int:
+    return bisect.bisect_right(TICKET_BUCKET_EDGES, amount)
+
+
+def ticket_bucket_label(bucket: int) -> str:
+    low = TICKET_BUCKET_EDGES[bucket - 1] if bucket > 0 else 0
+    if bucket >= len(TICKET_BUCKET_EDGES):
+        return f"{low}+"
+    return f"{low}-{TICKET_BUCKET_EDGES[bucket]}"
+
+
+def upsert_counters(model, keys: dict, deltas: dict, assign: dict = None, insert_only: dict = None, returning=None):
+    # INSERT ... ON CONFLICT DO UPDATE SET col = col + delta: one atomic
+    # statement, no read-modify-write. Runs on the tenant's shard.
+    # `assign` overwrites on conflict, `insert_only` is used for new rows only.
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    assign = assign or {}
+
+    stmt = insert(model).values(
+        **keys, **{k: max(v, 0) for k, v in deltas.items()}, **assign, **(insert_only or {})
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={
+            **{k: getattr(model, k) + v for k, v in deltas.items()},
+            **{k: stmt.excluded[k] for k in assign},
+        },
+    )
+    if returning is not None:
+        return db.session.execute(stmt.returning(returning)).scalar()
+    db.session.execute(stmt)
+    return None
+
+
+def record_charge_created(charge: Charge) -> None:
+    seen_at = charge.created_at or datetime.utcnow()
+    charge_count = upsert_counters(
+        ClientStat,
+        {"user_id": charge.user_id, "client_key": client_key(charge.client)},
+        {"charge_count": 1},
+        assign={"client": charge.client, "last_seen_at": seen_at},
+        insert_only={"first_seen_at": seen_at},
+        returning=ClientStat.charge_count,
+    )
+    upsert_counters(
+        ClientSummary,
+        {"user_id": charge.user_id},
+        {"charge_count": 1, "clients": 1 if charge_count == 1 else 0},
+    )
+
+
+def record_charge_status(charge: Charge, before: str, after: str) -> None:
+    was_paid, is_paid = before in REVENUE_STATUSES, after in REVENUE_STATUSES
+    if was_paid == is_paid:
+        return
+
+    sign = 1 if is_paid else -1
+    amount = charge_amount(charge.value)
+    paid_count = upsert_counters(
+        ClientStat,
+        {"user_id": charge.user_id, "client_key": client_key(charge.client)},
+        {"paid_count": sign, "paid_total": sign * amount},
+        insert_only={
+            "client": charge.client,
+            "first_seen_at": charge.created_at,
+            "last_seen_at": charge.created_at,
+        },
+        returning=ClientStat.paid_count,
+    )
+    # Crossing 0<->1 paid charges changes paying clients, 1<->2 repeat clients
+    upsert_counters(
+        ClientSummary,
+        {"user_id": charge.user_id},
+        {
+            "paid_count": sign,
+            "paid_total": sign * amount,
+            "paying_clients": sign if paid_count == (1 if sign > 0 else 0) else 0,
+            "repeat_clients": sign if paid_count == (2 if sign > 0 else 1) else 0,
+        },
+    )
+    upsert_counters(
+        ClientTicketBucket,
+        {"user_id": charge.user_id, "bucket": ticket_bucket(amount)},
+        {"count": sign, "total": sign * amount},
+    )
+
+
 def make_reset_link(rt_id: int, secret: str) -> str:
     frontend = os.getenv("FRONTEND_URL") or "http://localhost:5173"
     return f"{frontend}/reset?token={rt_id}.{secret}"
 
 
+# CHARGE PARTITIONS & COLD ARCHIVE
+# PostgreSQL: one partition per month (charge_YYYY_MM) plus charge_default.
+# SQLite: single table; months are logical ranges over ix_charge_created_at.
+# Either way archived months leave the hot table as gzip'd columnar JSON files.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+ARCHIVE_COLUMNS = ["id", "user_id", "client", "value", "message", "status", "created_at"]
+
+
+def month_start(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(dt: datetime) -> datetime:
+    return (dt.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def charge_partition_name(month: datetime) -> str:
+    return f"charge_{month:%Y_%m}"
+
+
+def charge_table_is_partitioned(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool(
+        conn.execute(
+            db.text(
+                "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('charge')"
+            )
+        ).scalar()
+    )
+
+
+def ensure_charge_partitions(engine, months_ahead: int = 2) -> list:
+    created = []
+    with engine.begin() as conn:
+        if not charge_table_is_partitioned(conn):
+            return created
+
+        conn.execute(db.text("CREATE TABLE IF NOT EXISTS charge_default PARTITION OF charge DEFAULT"))
+
+        month = month_start(datetime.utcnow())
+        # After partition-charges the legacy partition covers up to its bound
+        legacy_end = legacy_partition_end(conn)
+        if legacy_end and legacy_end > month:
+            month = legacy_end
+        for _ in range(months_ahead + 1):
+            name = charge_partition_name(month)
+            end = next_month(month)
+            if not conn.execute(db.text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+                create_charge_partition(conn, name, month, end)
+                created.append(name)
+            month = end
+    return created
+
+
+def create_charge_partition(conn, name: str, start: datetime, end: datetime) -> None:
+    bounds = {"start": start, "end": end}
+    in_default = conn.execute(
+        db.text(
+            "SELECT 1 FROM charge_default WHERE created_at >= :start AND created_at < :end LIMIT 1"
+        ),
+        bounds,
+    ).scalar()
+    # Rows already sitting in the default partition would violate the new
+    # bounds, so detach it, create the month and move them over before reattaching.
+    if in_default:
+        conn.execute(db.text("ALTER TABLE charge DETACH PARTITION charge_default"))
+    conn.execute(
+        db.text(
+            f"CREATE TABLE {name} PARTITION OF charge "
+            f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        )
+    )
+    if in_default:
+        conn.execute(
+            db.text(
+                "WITH moved AS (DELETE FROM charge_default "
+                "WHERE created_at >= :start AND created_at < :end RETURNING *) "
+                "INSERT INTO charge SELECT * FROM moved"
+            ),
+            bounds,
+        )
+        conn.execute(db.text("ALTER TABLE charge ATTACH PARTITION charge_default DEFAULT"))
+
+
+def legacy_partition_end(conn):
+    # Upper bound of charge_legacy once attached; monthly partitions start there
+    bound = conn.execute(
+        db.text(
+            "SELECT pg_get_expr(relpartbound, oid) FROM pg_class "
+            "WHERE oid = to_regclass('charge_legacy') AND relispartition"
+        )
+    ).scalar()
+    match = re.search(r"TO \('([^']+)'\)", bound or "")
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+def partition_legacy_charge_table(engine) -> bool:
+    # Databases created before partitioning keep a plain charge table. It is
+    # attached as the partition for everything before next month, behind a
+    # partitioned parent; no rows are copied.
+    with engine.connect() as conn:
+        if conn.dialect.name != "postgresql" or charge_table_is_partitioned(conn):
+            return False
+
+    cutoff = next_month(month_start(datetime.utcnow()))
+    # The slow parts run online first: a validated CHECK matching the partition
+    # bound lets ATTACH skip its scan, and a prebuilt (id, created_at) unique
+    # index is adopted instead of rebuilt under the exclusive lock.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(db.text("UPDATE charge SET created_at = now() WHERE created_at IS NULL"))
+        has_check = conn.execute(
+            db.text(
+                "SELECT 1 FROM pg_constraint "
+                "WHERE conrelid = to_regclass('charge') AND conname = 'charge_legacy_bound'"
+            )
+        ).scalar()
+        if not has_check:
+            conn.execute(
+                db.text(
+                    "ALTER TABLE charge ADD CONSTRAINT charge_legacy_bound "
+                    f"CHECK (created_at IS NOT NULL AND created_at < '{cutoff:%Y-%m-%d}') NOT VALID"
+                )
+            )
+        conn.execute(db.text("ALTER TABLE charge VALIDATE CONSTRAINT charge_legacy_bound"))
+        conn.execute(
+            db.text(
+                "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS charge_legacy_id_created_at "
+                "ON charge (id, created_at)"
+            )
+        )
+
+    # The swap itself only touches catalogs; give up instead of queueing
+    # every charge query behind a long-running transaction.
+    with engine.begin() as conn:
+        statements = [
+            "SET LOCAL lock_timeout = '5s'",
+            "ALTER TABLE charge RENAME TO charge_legacy",
+            "ALTER INDEX IF EXISTS charge_pkey RENAME TO charge_legacy_pkey",
+            "ALTER INDEX IF EXISTS ix_charge_user_created RENAME TO ix_charge_legacy_user_created",
+            "ALTER INDEX IF EXISTS ix_charge_created_at RENAME TO ix_charge_legacy_created_at",
+            "ALTER TABLE charge_legacy ALTER COLUMN created_at SET NOT NULL",  # proven by the CHECK
+            "CREATE TABLE charge (LIKE charge_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)",
+            "ALTER TABLE charge ADD PRIMARY KEY (id, created_at)",
+            # The id sequence must survive the legacy partition being archived
+            "ALTER SEQUENCE IF EXISTS charge_id_seq OWNED BY charge.id",
+        ]
+        for statement in statements:
+            conn.execute(db.text(statement))
+        for index in Charge.__table__.indexes:
+            conn.execute(CreateIndex(index))
+
+        conn.execute(
+            db.text(
+                f"CREATE TABLE {charge_partition_name(cutoff)} PARTITION OF charge "
+                f"FOR VALUES FROM ('{cutoff:%Y-%m-%d}') TO ('{next_month(cutoff):%Y-%m-%d}')"
+            )
+        )
+        conn.execute(db.text("CREATE TABLE charge_default PARTITION OF charge DEFAULT"))
+        conn.execute(
+            db.text(
+                "ALTER TABLE charge ATTACH PARTITION charge_legacy "
+                f"FOR VALUES FROM (MINVALUE) TO ('{cutoff:%Y-%m-%d}')"
+            )
+        )
+    return True
+
+
+def warn_if_charge_unpartitioned(engine, label: str) -> None:
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql" and not charge_table_is_partitioned(conn):
+            print(
+                f"⚠️  {label}: tabela charge não é particionada. "
+                "Rode 'flask partition-charges' para migrar"
+            )
+
+
+def archive_path(user_id: int, month: datetime) -> str:
+    return os.path.join(ARCHIVE_DIR, f"tenant_{user_id}", f"{charge_partition_name(month)}.jsonl.gz")
+
+
+def write_charge_archive(user_id: int, month: datetime, columns: dict) -> None:
+    path = archive_path(user_id, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    previous = b""
+    if os.path.exists(path):
+        # A run that crashed before deleting its rows archives them again: skip
+        # ids the file already holds so exports never see duplicates.
+        archived = {i for batch in read_charge_archive(path) for i in batch["id"]}
+        keep = [i for i, charge_id in enumerate(columns["id"]) if charge_id not in archived]
+        if not keep:
+            return
+        columns = {name: [values[i] for i in keep] for name, values in columns.items()}
+        with open(path, "rb") as f:
+            previous = f.read()
+
+    # Every batch is its own gzip member appended to the raw bytes (no
+    # recompression); the file is swapped in atomically.
+    line = json.dumps({"month": f"{month:%Y-%m}", "columns": columns}) + "\n"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(previous)
+        f.write(gzip.compress(line.encode("utf-8")))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_charge_archive(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)["columns"]
+
+
+def archive_charge_month(engine, month: datetime) -> int:
+    end = next_month(month)
+    in_month = db.and_(Charge.created_at >= month, Charge.created_at < end)
+
+    by_tenant = {}
+    with engine.connect() as conn:
+        rows = conn.execute(
+            db.select(*[getattr(Charge, name) for name in ARCHIVE_COLUMNS])
+            .where(in_month)
+            .order_by(Charge.created_at, Charge.id)
+            .execution_options(yield_per=1000)
+        )
+        for row in rows:
+            columns = by_tenant.setdefault(row.user_id, {name: [] for name in ARCHIVE_COLUMNS})
+            for name, value in zip(ARCHIVE_COLUMNS, row):
+                columns[name].append(value.isoformat() if isinstance(value, datetime) else value)
+
+    count = 0
+    for user_id, columns in by_tenant.items():
+        write_charge_archive(user_id, month, columns)
+        count += len(columns["id"])
+
+    # File is on disk before the rows leave the database
+    name = charge_partition_name(month)
+    with engine.begin() as conn:
+        has_partition = charge_table_is_partitioned(conn) and conn.execute(
+            db.text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}
+        ).scalar()
+        if has_partition:
+            conn.execute(db.text(f"ALTER TABLE charge DETACH PARTITION {name}"))
+            conn.execute(db.text(f"DROP TABLE {name}"))
+        else:
+            conn.execute(db.delete(Charge.__table__).where(in_month))
+    return count
+
+
+def iter_archived_charges(user_id: int):
+    # Only this tenant's files; newest month first, newest row first (matches export ordering)
+    pattern = os.path.join(ARCHIVE_DIR, f"tenant_{user_id}", "charge_*.jsonl.gz")
+    for path in sorted(glob.glob(pattern), reverse=True):
+        for columns in reversed(list(read_charge_archive(path))):
+            for i in range(len(columns["id"]) - 1, -1, -1):
+                yield {name: columns[name][i] for name in ARCHIVE_COLUMNS}
+
+
 # Initialize database and admin user
 with app.app_context():
-    db.create_all()
+    with schema_lock(db.engine):
+        db.create_all(bind_key=None)  # replicas are read-only; shards are created below
+        add_missing_columns(db.engine, User.__table__)
+        add_missing_indexes(db.engine, User.__table__)
+        add_missing_columns(db.engine, Charge.__table__)
+        add_missing_indexes(db.engine, Charge.__table__)
+        ensure_charge_partitions(db.engine)
+    warn_if_charge_unpartitioned(db.engine, "default")
+
+    for bind in SHARD_BINDS:
+        shard_engine = db.engines[bind]
+        with schema_lock(shard_engine):
+            for table_name in SHARDED_TABLES:
+                db.metadatas[None].tables[table_name].create(shard_engine, checkfirst=True)
+            add_missing_columns(shard_engine, Charge.__table__)
+            add_missing_indexes(shard_engine, Charge.__table__)
+            ensure_charge_partitions(shard_engine)
+        warn_if_charge_unpartitioned(shard_engine, bind)
+    if SHARD_BINDS:
+        with schema_lock(db.engine):
+            init_id_allocator("charge", Charge.__table__)
 
     admin_email = normalize_email(os.getenv("ADMIN_EMAIL") or "admin@pixflow.local")
     admin_password = os.getenv("ADMIN_PASSWORD") or "admin1234"
@@ -187,10 +1351,13 @@ def login():
     u = User.query.filter_by(email=email).first()
 
     if not u or not check_password_hash(u.password_hash, password):
+        audit("login_failed", "user", u.id if u else None, email=email)
         return jsonify({"error": "Credenciais inválidas"}), 401
     if not u.active:
+        audit("login_blocked", "user", u.id, actor_id=u.id)
         return jsonify({"error": "Conta desativada"}), 403
 
+    audit("login", "user", u.id, actor_id=u.id)
     token = create_access_token(identity=str(u.id), expires_delta=timedelta(hours=12))
 
     return jsonify(
@@ -266,6 +1433,7 @@ def set_mp_token():
     try:
         encrypted_token = encrypt_mp_token(mp_token)
         u.mp_token_encrypted = encrypted_token
+        u.mp_token_key_version = CURRENT_KEY_VERSION
         db.session.commit()
 
         return jsonify({
@@ -327,7 +1495,10 @@ def create_charge():
             # mp_payment_id=mp_payment_id,  # Campo futuro
         )
         db.session.add(c)
+        db.session.flush()
+        record_charge_created(c)
         db.session.commit()
+        audit("charge_created", "charge", c.id, value=value)
 
         return jsonify({"ok": True, "id": c.id})
 
@@ -340,6 +1511,7 @@ def create_charge():
 @app.get("/api/charges")
 @jwt_required()
 @limiter.limit("30 per hour")
+@replica_read
 def list_charges():
     u = get_current_user()
 
@@ -349,19 +1521,7 @@ def list_charges():
         .all()
     )
 
-    return jsonify(
-        [
-            {
-                "id": r.id,
-                "client": r.client,
-                "value": r.value,
-                "message": r.message,
-                "status": r.status,
-                "created_at": r.created_at.isoformat(),
-            }
-            for r in rows
-        ]
-    )
+    return jsonify([charge_to_json(r) for r in rows])
 
 
 @app.patch("/api/charges/<int:charge_id>")
@@ -380,14 +1540,33 @@ def update_charge(charge_id: int):
     if status not in ("pending", "paid", "canceled"):
         return jsonify({"error": "status inválido"}), 400
 
-    r.status = status
+    # Optional: the version the client saw; defaults to the one just read
+    expected_version = data.get("version", r.version)
+    if not isinstance(expected_version, int) or isinstance(expected_version, bool):
+        return jsonify({"error": "version inválida"}), 400
+    if expected_version != r.version:
+        return charge_conflict(r)
+
+    if status == r.status:
+        return jsonify({"ok": True, "version": r.version})
+
+    if status not in CHARGE_TRANSITIONS.get(r.status, set()):
+        return jsonify({"error": f"Transição inválida: {r.status} -> {status}"}), 400
+
+    previous_status = r.status
+    if not transition_charge(r, status, expected_version):
+        return charge_conflict(r)
+
+    record_charge_status(r, previous_status, status)
     db.session.commit()
-    return jsonify({"ok": True})
+    audit("charge_status", "charge", r.id, before=previous_status, after=status)
+    return jsonify({"ok": True, "version": expected_version + 1})
 
 
 @app.get("/api/export/charges.csv")
 @jwt_required()
 @limiter.limit("10 per hour")  # Exportação é recurso-intensiva
+@replica_read
 def export_csv():
     u = get_current_user()
     rows = (
@@ -403,6 +1582,10 @@ def export_csv():
     for r in rows:
         w.writerow([r.id, r.client, r.value, r.status, r.created_at.isoformat()])
 
+    if request.args.get("include_archive") in ("1", "true"):
+        for r in iter_archived_charges(u.id):
+            w.writerow([r["id"], r["client"], r["value"], r["status"], r["created_at"]])
+
     return Response(
         output.getvalue(),
         mimetype="text/csv",
@@ -414,6 +1597,7 @@ def export_csv():
 @app.get("/api/dashboard/stats")
 @jwt_required()
 @limiter.limit("20 per hour")
+@replica_read
 def dashboard_stats():
     u = get_current_user()
     
@@ -503,9 +1687,74 @@ def dashboard_stats():
     })
 
 
+@app.get("/api/analytics/clients")
+@jwt_required()
+@limiter.limit("30 per hour")
+@replica_read
+def analytics_clients():
+    u = get_current_user()
+
+    sort_columns = {
+        "revenue": ClientStat.paid_total,
+        "count": ClientStat.charge_count,
+        "recent": ClientStat.last_seen_at,
+    }
+    sort = request.args.get("sort", "revenue")
+    if sort not in sort_columns:
+        return jsonify({"error": "sort deve ser revenue, count ou recent"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "limit inválido"}), 400
+
+    # Index scans on (user_id, <sort column>); cost does not grow with charges
+    top = (
+        ClientStat.query.filter_by(user_id=u.id)
+        .order_by(sort_columns[sort].desc())
+        .limit(limit)
+        .all()
+    )
+    summary = ClientSummary.query.get(u.id)
+    buckets = {b.bucket: b for b in ClientTicketBucket.query.filter_by(user_id=u.id).all()}
+
+    paying = summary.paying_clients if summary else 0
+    return jsonify({
+        "summary": {
+            "clients": summary.clients if summary else 0,
+            "paying_clients": paying,
+            "repeat_clients": summary.repeat_clients if summary else 0,
+            "repeat_rate_percent": round(summary.repeat_clients / paying * 100, 1) if paying else 0.0,
+            "charge_count": summary.charge_count if summary else 0,
+            "paid_count": summary.paid_count if summary else 0,
+            "paid_total": round(summary.paid_total, 2) if summary else 0.0,
+        },
+        "top": [
+            {
+                "client": c.client,
+                "charge_count": c.charge_count,
+                "paid_count": c.paid_count,
+                "paid_total": round(c.paid_total, 2),
+                "average_ticket": round(c.paid_total / c.paid_count, 2) if c.paid_count else 0.0,
+                "first_seen_at": c.first_seen_at.isoformat(),
+                "last_seen_at": c.last_seen_at.isoformat(),
+            }
+            for c in top
+        ],
+        "ticket_histogram": [
+            {
+                "bucket": ticket_bucket_label(i),
+                "count": buckets[i].count if i in buckets else 0,
+                "total": round(buckets[i].total, 2) if i in buckets else 0.0,
+            }
+            for i in range(len(TICKET_BUCKET_EDGES) + 1)
+        ],
+    })
+
+
 @app.get("/api/report/today")
 @jwt_required()
 @limiter.limit("30 per hour")
+@replica_read
 def report_today():
     u = get_current_user()
     
@@ -548,43 +1797,64 @@ def refund_charge(charge_id: int):
             "error": "Token do Mercado Pago não configurado"
         }), 400
     
-    if charge.status != "approved":
+    # A refund left "refunding" by a worker that died mid-call can be retried:
+    # Mercado Pago answers "already refunded" if the first attempt went through.
+    # Claims from before refund_claimed_at existed have no timestamp: stale too.
+    stale_claim = charge.status == "refunding" and (
+        charge.refund_claimed_at is None
+        or charge.refund_claimed_at < datetime.utcnow() - timedelta(seconds=REFUND_CLAIM_TIMEOUT_SECONDS)
+    )
+    if charge.status == "refunding" and not stale_claim:
+        return jsonify({"error": "Estorno em andamento, tente novamente em instantes"}), 409
+    if "refunding" not in CHARGE_TRANSITIONS.get(charge.status, set()) and not stale_claim:
         return jsonify({
             "error": f"Só pode estornar cobranças 'approved'. Status: {charge.status}"
         }), 400
-    
+
     try:
         mp_user_token = decrypt_mp_token(u.mp_token_encrypted)
     except ValueError as e:
         return jsonify({"error": f"Erro ao acessar credenciais: {str(e)}"}), 500
-    
-    try:
-        mercadopago.Configuration.access_token = mp_user_token
-        refund = mercadopago.payment.refund(charge_id)
-        refund_result = refund.get_response()
-        
-        if refund_result.get("status") != 200:
-            error_msg = refund_result.get("message", "Erro desconhecido")
-            return jsonify({"error": f"Mercado Pago: {error_msg}"}), 400
-        
-        charge.status = "refunded"
+
+    # Claim the charge before talking to Mercado Pago: a concurrent refund or
+    # status change loses the CAS here instead of after the money moved.
+    claimed_version = charge.version + 1
+    if not transition_charge(charge, "refunding", charge.version, refund_claimed_at=datetime.utcnow()):
+        return charge_conflict(charge)
+    db.session.commit()
+
+    def release_claim():
+        if transition_charge(charge, "approved", claimed_version, refund_claimed_at=None):
+            db.session.commit()
+        else:
+            db.session.rollback()
+
+    def finish_refund():
+        if not transition_charge(charge, "refunded", claimed_version, refund_claimed_at=None):
+            return charge_conflict(charge)
+        record_charge_status(charge, "refunding", "refunded")
         db.session.commit()
-        
+        audit("charge_refunded", "charge", charge_id)
+
         return jsonify({
             "ok": True,
             "message": "Estorno solicitado com sucesso",
             "charge_id": charge_id,
             "new_status": "refunded"
         })
-    
+
+    try:
+        mercadopago.Configuration.access_token = mp_user_token
+        refund = mercadopago.payment.refund(charge_id)
+        refund_result = refund.get_response()
     except Exception as e:
         error_message = str(e)
         
         if "already refunded" in error_message.lower():
-            return jsonify({
-                "error": "Este pagamento já foi estornado"
-            }), 400
-        elif "timeout" in error_message.lower():
+            return finish_refund()
+
+        release_claim()
+        if "timeout" in error_message.lower():
             return jsonify({
                 "error": "Prazo para estorno expirou (máx 90 dias)"
             }), 400
@@ -593,29 +1863,105 @@ def refund_charge(charge_id: int):
                 "error": f"Erro ao processar estorno: {error_message}"
             }), 400
 
+    if refund_result.get("status") != 200:
+        release_claim()
+        error_msg = refund_result.get("message", "Erro desconhecido")
+        return jsonify({"error": f"Mercado Pago: {error_msg}"}), 400
+
+    return finish_refund()
+
 
 @app.get("/api/admin/users")
 @jwt_required()
 @limiter.limit("20 per hour")
+@replica_read
 def admin_users():
     if not require_admin():
         return jsonify({"error": "Sem permissão"}), 403
 
-    users = User.query.order_by(User.created_at.desc()).all()
-    return jsonify(
-        [
-            {
-                "id": u.id,
-                "email": u.email,
-                "name": u.name,
-                "role": u.role,
-                "active": u.active,
-                "must_change_password": bool(u.must_change_password),
-                "created_at": u.created_at.isoformat(),
-            }
-            for u in users
-        ]
-    )
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 200)
+    except ValueError:
+        return jsonify({"error": "limit inválido"}), 400
+
+    q = normalize_email(request.args.get("q"))
+    cursor = (request.args.get("cursor") or "").strip()
+    with_aggregates = request.args.get("aggregates") in ("1", "true")
+
+    query = User.query
+    if q:
+        pattern = like_prefix(q)
+        query = query.filter(
+            db.or_(
+                User.email.like(pattern, escape="\\"),
+                db.func.lower(User.name).like(pattern, escape="\\"),
+            )
+        )
+
+    if cursor:
+        try:
+            ts, last_id = parse_keyset_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "cursor inválido"}), 400
+        query = query.filter(keyset_before(User, ts, last_id))
+
+    users = query.order_by(User.created_at.desc(), User.id.desc()).limit(limit + 1).all()
+    has_more = len(users) > limit
+    users = users[:limit]
+
+    # One grouped query per shard for the whole page instead of one per user
+    aggregates = {}
+    if with_aggregates and users:
+        since = datetime.utcnow() - timedelta(days=30)
+        recent_paid = db.and_(
+            Charge.status.in_(["approved", "paid"]),
+            Charge.created_at >= since,
+        )
+        ids_by_bind = {}
+        for user_id, bind in tenant_binds([u.id for u in users]).items():
+            ids_by_bind.setdefault(bind, []).append(user_id)
+
+        statements = {
+            bind: db.select(
+                Charge.user_id,
+                db.func.count(Charge.id),
+                db.func.sum(db.case((recent_paid, charge_value_number()), else_=0.0)),
+                db.func.max(Charge.created_at),
+            )
+            .where(Charge.user_id.in_(user_ids))
+            .group_by(Charge.user_id)
+            for bind, user_ids in ids_by_bind.items()
+        }
+        for rows in run_on_binds(statements).values():
+            for user_id, count, revenue, last in rows:
+                aggregates[user_id] = {
+                    "charge_count": count,
+                    "revenue_30d": round(float(revenue or 0), 2),
+                    "last_activity_at": last.isoformat() if last else None,
+                }
+
+    items = []
+    for u in users:
+        item = {
+            "id": u.id,
+            "email": u.email,
+            "name": u.name,
+            "role": u.role,
+            "active": u.active,
+            "must_change_password": bool(u.must_change_password),
+            "created_at": u.created_at.isoformat(),
+        }
+        if with_aggregates:
+            item.update(
+                aggregates.get(
+                    u.id,
+                    {"charge_count": 0, "revenue_30d": 0.0, "last_activity_at": None},
+                )
+            )
+        items.append(item)
+
+    next_cursor = keyset_cursor(users[-1]) if has_more else None
+    return jsonify({"items": items, "next_cursor": next_cursor})
 
 
 @app.post("/api/admin/invite")
@@ -648,7 +1994,10 @@ def admin_invite():
         must_change_password=True,
     )
     db.session.add(u)
+    db.session.flush()
+    assign_tenant_shard(u.id)
     db.session.commit()
+    audit("admin_invite", "user", u.id, email=email)
 
     return jsonify({"ok": True, "temp_password": temp_pw})
 
@@ -669,6 +2018,7 @@ def admin_toggle(user_id: int):
 
     u.active = not u.active
     db.session.commit()
+    audit("admin_toggle", "user", u.id, active=u.active)
     return jsonify({"ok": True, "active": u.active})
 
 
@@ -686,15 +2036,163 @@ def admin_delete_user(user_id: int):
     if u.role == "admin":
         return jsonify({"error": "Não pode remover admin"}), 400
 
-    Charge.query.filter_by(user_id=u.id).delete()
+    with tenant_bind_for(u.id):
+        Charge.query.filter_by(user_id=u.id).delete()
+        for model in CLIENT_STAT_TABLES:
+            model.query.filter_by(user_id=u.id).delete()
     ResetToken.query.filter_by(user_id=u.id).delete()
+    TenantShard.query.filter_by(user_id=u.id).delete()
 
+    email = u.email
     db.session.delete(u)
     db.session.commit()
+    audit("admin_delete_user", "user", user_id, email=email)
 
     return jsonify({"ok": True})
 
 
+@app.get("/api/admin/shards")
+@jwt_required()
+@limiter.limit("20 per hour")
+@replica_read
+def admin_shards():
+    if not require_admin():
+        return jsonify({"error": "Sem permissão"}), 403
+
+    tenants = dict(
+        db.session.query(TenantShard.bind, db.func.count(TenantShard.user_id))
+        .group_by(TenantShard.bind)
+        .all()
+    )
+    since = datetime.utcnow() - timedelta(days=30)
+    statements = {
+        bind: db.select(
+            db.func.count(Charge.id),
+            db.func.count(db.distinct(Charge.user_id)),
+            db.func.sum(db.case((Charge.created_at >= since, 1), else_=0)),
+        )
+        for bind in [None] + SHARD_BINDS
+    }
+    results = run_on_binds(statements)
+
+    return jsonify(
+        [
+            {
+                "bind": bind or "default",
+                "mapped_tenants": tenants.get(bind, 0),
+                "tenants_with_charges": results[bind][0][1],
+                "charges": results[bind][0][0],
+                "charges_30d": int(results[bind][0][2] or 0),
+            }
+            for bind in statements
+        ]
+    )
+
+
+@app.get("/api/admin/audit")
+@jwt_required()
+@limiter.limit("60 per hour")
+@replica_read
+def admin_audit():
+    if not require_admin():
+        return jsonify({"error": "Sem permissão"}), 403
+
+    try:
+        limit = min(max(int(request.args.get("limit", 100)), 1), 500)
+        since = datetime.fromisoformat(request.args["since"]) if request.args.get("since") else None
+        until = datetime.fromisoformat(request.args["until"]) if request.args.get("until") else None
+        actor_id = int(request.args["actor_id"]) if request.args.get("actor_id") else None
+    except ValueError:
+        return jsonify({"error": "parâmetros inválidos"}), 400
+
+    query = AuditEvent.query
+    if since:
+        query = query.filter(AuditEvent.created_at >= since)
+    if until:
+        query = query.filter(AuditEvent.created_at < until)
+    if actor_id is not None:
+        query = query.filter(AuditEvent.actor_id == actor_id)
+    if request.args.get("action"):
+        query = query.filter(AuditEvent.action == request.args["action"])
+
+    cursor = (request.args.get("cursor") or "").strip()
+    if cursor:
+        try:
+            ts, last_id = parse_keyset_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "cursor inválido"}), 400
+        query = query.filter(keyset_before(AuditEvent, ts, last_id))
+
+    events = query.order_by(AuditEvent.created_at.desc(), AuditEvent.id.desc()).limit(limit + 1).all()
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    return jsonify({
+        "items": [
+            {
+                "id": e.id,
+                "created_at": e.created_at.isoformat(),
+                "actor_id": e.actor_id,
+                "action": e.action,
+                "target_type": e.target_type,
+                "target_id": e.target_id,
+                "ip": e.ip,
+                "details": json.loads(e.details) if e.details else None,
+            }
+            for e in events
+        ],
+        "next_cursor": keyset_cursor(events[-1]) if has_more else None,
+    })
+
+
+@app.get("/api/admin/profiles")
+@jwt_required()
+@limiter.limit("60 per hour")
+def admin_profiles():
+    if not require_admin():
+        return jsonify({"error": "Sem permissão"}), 403
+
+    items = []
+    for path in sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), reverse=True):
+        try:
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue  # rotated away or still being written
+        meta.pop("stats", None)
+        meta.pop("sql", None)
+        items.append(meta)
+    return jsonify({"enabled": PROFILING_ENABLED, "items": items})
+
+
+@app.get("/api/admin/profiles/<profile_id>")
+@jwt_required()
+@limiter.limit("60 per hour")
+def admin_profile(profile_id: str):
+    if not require_admin():
+        return jsonify({"error": "Sem permissão"}), 403
+
+    raw = profile_id.endswith(".prof")
+    profile_id = profile_id[: -len(".prof")] if raw else profile_id
+    if not PROFILE_ID_RE.match(profile_id):
+        return jsonify({"error": "Não encontrado"}), 404
+
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.prof" if raw else f"{profile_id}.json")
+    if not os.path.exists(path):
+        return jsonify({"error": "Não encontrado"}), 404
+
+    if raw:
+        # Open with: python -m pstats <file> (or snakeviz)
+        with open(path, "rb") as f:
+            return Response(
+                f.read(),
+                mimetype="application/octet-stream",
+                headers={"Content-Disposition": f"attachment; filename={profile_id}.prof"},
+            )
+    with open(path, encoding="utf-8") as f:
+        return Response(f.read(), mimetype="application/json")
+
+
 @app.post("/api/admin/reset-link")
 @jwt_required()
 @limiter.limit("10 per hour")
@@ -718,6 +2216,7 @@ def admin_reset_link():
     db.session.add(rt)
     db.session.commit()
 
+    audit("admin_reset_link", "user", u.id)
     link = make_reset_link(rt.id, secret)
     return jsonify({"ok": True, "link": link})
 
@@ -764,5 +2263,342 @@ def reset_password():
     return jsonify({"ok": True})
 
 
+# MAINTENANCE COMMANDS (flask --app app <command>)
+@app.cli.command("charge-partitions")
+@click.option("--months-ahead", type=int, default=2, show_default=True)
+def charge_partitions_command(months_ahead: int):
+    """Create upcoming monthly charge partitions (PostgreSQL)."""
+    with db.engine.connect() as conn:
+        if conn.dialect.name != "postgresql":
+            click.echo("SQLite: sem partições, nada a fazer")
+            return
+        if not charge_table_is_partitioned(conn):
+            click.echo("⚠️  Tabela charge não é particionada: rode 'flask partition-charges' antes")
+            return
+    for bind in [None] + SHARD_BINDS:
+        with schema_lock(db.engines[bind]):
+            created = ensure_charge_partitions(db.engines[bind], months_ahead)
+        for name in created:
+            click.echo(f"✅ {bind or 'default'}: {name}")
+
+
+@app.cli.command("partition-charges")
+def partition_charges_command():
+    """Migrate a pre-partitioning charge table to the partitioned layout (PostgreSQL)."""
+    for bind in [None] + SHARD_BINDS:
+        engine = db.engines[bind]
+        with schema_lock(engine):
+            migrated = partition_legacy_charge_table(engine)
+        click.echo(f"{'✅' if migrated else '—'} {bind or 'default'}: {'migrada' if migrated else 'nada a fazer'}")
+
+
+@app.cli.command("archive-charges")
+@click.option(
+    "--retention-months",
+    type=int,
+    default=lambda: int(os.getenv("CHARGE_RETENTION_MONTHS") or 6),
+    show_default="CHARGE_RETENTION_MONTHS ou 6",
+)
+def archive_charges_command(retention_months: int):
+    """Move charges older than the retention window to ARCHIVE_DIR."""
+    cutoff = month_start(datetime.utcnow())
+    for _ in range(retention_months):
+        cutoff = month_start(cutoff - timedelta(days=1))
+
+    for bind in [None] + SHARD_BINDS:
+        engine = db.engines[bind]
+        with engine.connect() as conn:
+            oldest = conn.execute(db.select(db.func.min(Charge.created_at))).scalar()
+        if not oldest or oldest >= cutoff:
+            click.echo(f"{bind or 'default'}: nada para arquivar")
+            continue
+
+        month = month_start(oldest)
+        while month < cutoff:
+            count = archive_charge_month(engine, month)
+            if count:
+                click.echo(f"📦 {bind or 'default'} {month:%Y-%m}: {count} cobranças -> {ARCHIVE_DIR}")
+            month = next_month(month)
+
+
+# Columns a tenant can still change after a row was copied to the new shard
+CHARGE_MUTABLE_COLUMNS = ["status", "version"]
+
+
+def copy_tenant_charges(source, target, user_id: int, after_id: int, batch_size: int) -> int:
+    table = Charge.__table__
+    while True:
+        with source.connect() as conn:
+            rows = conn.execute(
+                db.select(table)
+                .where(table.c.user_id == user_id, table.c.id > after_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            ).mappings().all()
+        if not rows:
+            return after_id
+        with target.begin() as conn:
+            conn.execute(db.insert(table), [dict(r) for r in rows])
+        after_id = rows[-1]["id"]
+
+
+def tenant_charge_snapshot(engine, user_id: int) -> dict:
+    # id -> mutable columns, enough to tell whether two copies agree
+    table = Charge.__table__
+    columns = [table.c.id] + [table.c[name] for name in CHARGE_MUTABLE_COLUMNS]
+    with engine.connect() as conn:
+        rows = conn.execute(db.select(*columns).where(table.c.user_id == user_id))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def sync_tenant_charges(source, target, user_id: int, batch_size: int = 1000) -> int:
+    table = Charge.__table__
+    current = tenant_charge_snapshot(source, user_id)
+    copied = tenant_charge_snapshot(target, user_id)
+
+    # Ids allocated before the copy passed them but committed after it
+    missing = sorted(set(current) - set(copied))
+    stale = sorted(set(copied) - set(current))
+    changed = [
+        dict(zip(["_id"] + CHARGE_MUTABLE_COLUMNS, (charge_id,) + values))
+        for charge_id, values in current.items()
+        if charge_id in copied and copied[charge_id] != values
+    ]
+
+    for i in range(0, len(missing), batch_size):
+        with source.connect() as conn:
+            rows = conn.execute(
+                db.select(table).where(table.c.id.in_(missing[i:i + batch_size]))
+            ).mappings().all()
+        with target.begin() as conn:
+            conn.execute(db.insert(table), [dict(r) for r in rows])
+    with target.begin() as conn:
+        if changed:
+            conn.execute(
+                db.update(table)
+                .where(table.c.id == db.bindparam("_id"))
+                .values({name: db.bindparam(name) for name in CHARGE_MUTABLE_COLUMNS}),
+                changed,
+            )
+        if stale:
+            conn.execute(db.delete(table).where(table.c.user_id == user_id, table.c.id.in_(stale)))
+    return len(missing) + len(changed) + len(stale)
+
+
+def set_tenant_shard(user_id: int, **values) -> None:
+    table = TenantShard.__table__
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            db.update(table).where(table.c.user_id == user_id).values(**values)
+        ).rowcount
+        if not updated:
+            conn.execute(db.insert(table).values(user_id=user_id, **{"bind": None, "moving": False, **values}))
+
+
+@app.cli.command("move-tenant")
+@click.argument("user_id", type=int)
+@click.argument("target")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+@click.option(
+    "--grace-seconds",
+    type=float,
+    default=35,
+    show_default=True,
+    help="Espera após congelar escritas (maior que o timeout do gunicorn).",
+)
+def move_tenant_command(user_id: int, target: str, batch_size: int, grace_seconds: float):
+    """Copy a tenant's charges to TARGET (shard_N or default) and cut over."""
+    target_bind = None if target == "default" else target
+    if target_bind is not None and target_bind not in SHARD_BINDS:
+        raise click.BadParameter(f"use default ou um de {SHARD_BINDS}", param_hint="TARGET")
+    if not User.query.get(user_id):
+        raise click.BadParameter("usuário não encontrado", param_hint="USER_ID")
+
+    row = tenant_shard_row(user_id)
+    source_bind = row.bind if row else None
+    if source_bind == target_bind:
+        click.echo("Tenant já está nesse shard")
+        return
+
+    table = Charge.__table__
+    source, target_engine = db.engines[source_bind], db.engines[target_bind]
+
+    # Leftovers from an interrupted move
+    with target_engine.begin() as conn:
+        conn.execute(db.delete(table).where(table.c.user_id == user_id))
+
+    # 1) Bulk copy while the tenant keeps working
+    last_id = copy_tenant_charges(source, target_engine, user_id, 0, batch_size)
+    click.echo(f"Cópia inicial até id {last_id}")
+
+    # 2) Freeze writes, let in-flight requests finish, copy the delta
+    set_tenant_shard(user_id, moving=True)
+    try:
+        time.sleep(grace_seconds)
+        last_id = copy_tenant_charges(source, target_engine, user_id, last_id, batch_size)
+        changed = sync_tenant_charges(source, target_engine, user_id, batch_size)
+        click.echo(f"Delta copiado até id {last_id}, {changed} linha(s) sincronizada(s)")
+        # Never cut over (and later delete the source) unless both copies agree
+        if tenant_charge_snapshot(source, user_id) != tenant_charge_snapshot(target_engine, user_id):
+            raise click.ClickException("Cópias divergentes após sincronizar; tenant mantido na origem")
+
+        # Analytics rows are small per tenant; copy them whole while frozen
+        for model in CLIENT_STAT_TABLES:
+            stat_table = model.__table__
+            with source.connect() as conn:
+                rows = conn.execute(
+                    db.select(stat_table).where(stat_table.c.user_id == user_id)
+                ).mappings().all()
+            with target_engine.begin() as conn:
+                conn.execute(db.delete(stat_table).where(stat_table.c.user_id == user_id))
+                if rows:
+                    conn.execute(db.insert(stat_table), [dict(r) for r in rows])
+
+        # 3) Cut over
+        set_tenant_shard(user_id, bind=target_bind, moving=False)
+    except BaseException:
+        set_tenant_shard(user_id, moving=False)
+        raise
+
+    # 4) Clean up the old copy in batches
+    while True:
+        with source.begin() as conn:
+            ids = conn.execute(
+                db.select(table.c.id).where(table.c.user_id == user_id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+            conn.execute(db.delete(table).where(table.c.id.in_(ids)))
+    with source.begin() as conn:
+        for model in CLIENT_STAT_TABLES:
+            conn.execute(db.delete(model.__table__).where(model.__table__.c.user_id == user_id))
+
+    click.echo(f"✅ Tenant {user_id}: {source_bind or 'default'} -> {target_bind or 'default'}")
+
+
+def rebuild_client_analytics(user_id: int) -> int:
+    # Full recount from the tenant's hot charges (archived months not included)
+    stats, buckets = {}, {}
+    summary = {"clients": 0, "paying_clients": 0, "repeat_clients": 0,
+               "charge_count": 0, "paid_count": 0, "paid_total": 0.0}
+
+    rows = db.session.execute(
+        db.select(Charge.client, Charge.value, Charge.status, Charge.created_at)
+        .where(Charge.user_id == user_id)
+        .order_by(Charge.created_at)
+        .execution_options(yield_per=1000)
+    )
+    for client, value, status, created_at in rows:
+        key = client_key(client)
+        stat = stats.setdefault(key, {
+            "user_id": user_id, "client_key": key, "client": client,
+            "charge_count": 0, "paid_count": 0, "paid_total": 0.0,
+            "first_seen_at": created_at, "last_seen_at": created_at,
+        })
+        stat["client"], stat["last_seen_at"] = client, created_at
+        stat["charge_count"] += 1
+        summary["charge_count"] += 1
+
+        if status in REVENUE_STATUSES:
+            amount = charge_amount(value)
+            stat["paid_count"] += 1
+            stat["paid_total"] += amount
+            summary["paid_count"] += 1
+            summary["paid_total"] += amount
+            bucket = buckets.setdefault(
+                ticket_bucket(amount),
+                {"user_id": user_id, "bucket": ticket_bucket(amount), "count": 0, "total": 0.0},
+            )
+            bucket["count"] += 1
+            bucket["total"] += amount
+
+    summary["clients"] = len(stats)
+    summary["paying_clients"] = sum(1 for s in stats.values() if s["paid_count"] >= 1)
+    summary["repeat_clients"] = sum(1 for s in stats.values() if s["paid_count"] >= 2)
+
+    for model in CLIENT_STAT_TABLES:
+        model.query.filter_by(user_id=user_id).delete()
+    if stats:
+        db.session.execute(db.insert(ClientStat), list(stats.values()))
+    if buckets:
+        db.session.execute(db.insert(ClientTicketBucket), list(buckets.values()))
+    db.session.add(ClientSummary(user_id=user_id, **summary))
+    db.session.commit()
+    return len(stats)
+
+
+@app.cli.command("rebuild-client-analytics")
+@click.option("--user-id", type=int, default=None, help="Só um cliente (padrão: todos).")
+def rebuild_client_analytics_command(user_id: int):
+    """Recount client analytics from charges (backfill or repair)."""
+    if user_id is not None:
+        user_ids = [user_id]
+    else:
+        user_ids = [uid for (uid,) in db.session.query(User.id).order_by(User.id)]
+
+    for uid in user_ids:
+        with tenant_bind_for(uid):
+            clients = rebuild_client_analytics(uid)
+        click.echo(f"Usuário {uid}: {clients} cliente(s)")
+
+
+def rotate_mp_token_batch(after_id: int, batch_size: int):
+    # One short transaction per batch; returns (last_id, rotated, failed)
+    table = User.__table__
+    needs_rotation = db.or_(
+        table.c.mp_token_key_version.is_(None),
+        table.c.mp_token_key_version < CURRENT_KEY_VERSION,
+    )
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            db.select(table.c.id, table.c.mp_token_encrypted)
+            .where(table.c.id > after_id, table.c.mp_token_encrypted.is_not(None), needs_rotation)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+    if not rows:
+        return None, 0, 0
+
+    rotated = failed = 0
+    with db.engine.begin() as conn:
+        for user_id, token in rows:
+            try:
+                new_token = cipher.rotate(token.encode()).decode()
+            except InvalidToken:
+                failed += 1
+                print(f"⚠️  Usuário {user_id}: token não abre com nenhuma chave configurada")
+                continue
+            # Skip if the user saved a new token meanwhile
+            rotated += conn.execute(
+                db.update(table)
+                .where(table.c.id == user_id, table.c.mp_token_encrypted == token)
+                .values(mp_token_encrypted=new_token, mp_token_key_version=CURRENT_KEY_VERSION)
+            ).rowcount
+    return rows[-1].id, rotated, failed
+
+
+@app.cli.command("rotate-mp-tokens")
+@click.option("--batch-size", type=int, default=200, show_default=True)
+@click.option("--pause", type=float, default=0.1, show_default=True, help="Segundos entre lotes.")
+def rotate_mp_tokens_command(batch_size: int, pause: float):
+    """Re-encrypt stored Mercado Pago tokens with the newest key version."""
+    if encryption_key_is_ephemeral:
+        raise click.ClickException("Configure ENCRYPTION_KEY(S) antes de rotacionar")
+
+    # Progress lives in the rows themselves (mp_token_key_version),
+    # so an interrupted run simply resumes where it stopped.
+    last_id, total_rotated, total_failed = 0, 0, 0
+    while True:
+        last_id, rotated, failed = rotate_mp_token_batch(last_id, batch_size)
+        if last_id is None:
+            break
+        total_rotated += rotated
+        total_failed += failed
+        click.echo(f"... até id {last_id}: {total_rotated} rotacionado(s)")
+        time.sleep(pause)
+
+    click.echo(f"✅ {total_rotated} token(s) na versão {CURRENT_KEY_VERSION}, {total_failed} falha(s)")
+
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=5000, debug=True)
@@ -10,6 +10,12 @@ export async function apiFetch(path, { token, method = "GET", body, params } = {
   if (body) headers["Content-Type"] = "application/json";
   if (token) headers["Authorization"] = "Bearer " + token;
 
+  // Read-your-writes: keep reads on the primary for a while after a write
+  const stickyUntil = localStorage.getItem("pixflow_sticky_until");
+  if (stickyUntil && Number(stickyUntil) * 1000 > Date.now()) {
+    headers["X-PixFlow-Sticky-Until"] = stickyUntil;
+  }
+
   let url = API + "/api" + path;
   if (params) {
     const qs = new URLSearchParams(params).toString();
@@ -22,6 +28,9 @@ export async function apiFetch(path, { token, method = "GET", body, params } = {
     body: body ? JSON.stringify(body) : undefined
   });
 
+  const sticky = res.headers.get("X-PixFlow-Sticky-Until");
+  if (sticky) localStorage.setItem("pixflow_sticky_until", sticky);
+
   const text = await res.text();
   let data = null;
 
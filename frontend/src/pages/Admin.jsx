@@ -4,21 +4,33 @@ import { Toast } from "../ui.jsx";
 
 export default function Admin({ token, setError }) {
   const [users, setUsers] = useState([]);
+  const [search, setSearch] = useState("");
+  const [nextCursor, setNextCursor] = useState(null);
   const [email, setEmail] = useState("");
   const [name, setName] = useState("");
   const [toast, setToast] = useState("");
 
-  async function load() {
+  async function load(cursor) {
     setError("");
     try {
-      const data = await apiFetch("/admin/users", { token });
-      setUsers(Array.isArray(data) ? data : (data.items || []));
+      const params = { limit: 50, aggregates: 1 };
+      if (search.trim()) params.q = search.trim();
+      if (cursor) params.cursor = cursor;
+
+      const data = await apiFetch("/admin/users", { token, params });
+      const items = Array.isArray(data) ? data : (data.items || []);
+      setUsers(cursor ? (prev) => [...prev, ...items] : items);
+      setNextCursor(data && data.next_cursor ? data.next_cursor : null);
     } catch (e) {
       setError(e.message);
     }
   }
 
-  useEffect(() => { load(); /* eslint-disable-next-line */ }, []);
+  useEffect(() => {
+    const t = setTimeout(() => load(), 300);
+    return () => clearTimeout(t);
+    /* eslint-disable-next-line */
+  }, [search]);
 
   async function invite() {
     setToast("");
@@ -105,11 +117,21 @@ export default function Admin({ token, setError }) {
         <div className="h1">Usuários</div>
         <div className="h2">bloquear / resetar</div>
 
+        <input
+          className="input"
+          value={search}
+          onChange={(e) => setSearch(e.target.value)}
+          placeholder="Buscar por email ou nome"
+        />
+
         <table className="table">
           <thead>
             <tr>
               <th>Email</th>
               <th>Role</th>
+              <th>Cobranças</th>
+              <th>Receita 30d</th>
+              <th>Última atividade</th>
               <th>Status</th>
               <th>Ações</th>
             </tr>
@@ -120,6 +142,9 @@ export default function Admin({ token, setError }) {
                 <tr key={u.id}>
                   <td>{u.email}</td>
                   <td>{u.role}</td>
+                  <td>{u.charge_count ?? 0}</td>
+                  <td>R$ {(u.revenue_30d ?? 0).toFixed(2)}</td>
+                  <td>{u.last_activity_at ? new Date(u.last_activity_at).toLocaleString() : "-"}</td>
                   <td>
                     <span className={"badge " + (u.active ? "paid" : "canceled")}>
                       {u.active ? "ativo" : "bloqueado"}
@@ -144,7 +169,7 @@ export default function Admin({ token, setError }) {
               ))
             ) : (
               <tr>
-                <td colSpan="4" style={{ textAlign: "center", padding: 20 }}>
+                <td colSpan="7" style={{ textAlign: "center", padding: 20 }}>
                   Nenhum usuário encontrado.
                 </td>
               </tr>
@@ -152,6 +177,14 @@ export default function Admin({ token, setError }) {
           </tbody>
         </table>
 
+        {nextCursor ? (
+          <div style={{ marginTop: 12 }}>
+            <button className="btn secondary" onClick={() => load(nextCursor)} style={{ width: "100%" }}>
+              Carregar mais
+            </button>
+          </div>
+        ) : null}
+
         <div className="toast">Admin não dá pra bloquear pelo sistema (proteção).</div>
       </div>
     </div>
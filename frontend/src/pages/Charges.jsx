@@ -70,15 +70,21 @@ Quando pagar me manda o comprovante por aqui 🙏
     }
   }
 
-  async function setStatus(id, status) {
+  // O backend devolve as transições permitidas pelo status atual
+  function canMove(c, status) {
+    return (c.allowed_transitions || []).includes(status);
+  }
+
+  async function setStatus(c, status) {
     setToast("");
     setError("");
     try {
-      await apiFetch(`/charges/${id}`, { token, method: "PATCH", body: { status } });
+      await apiFetch(`/charges/${c.id}`, { token, method: "PATCH", body: { status, version: c.version } });
       await load();
     } catch (e) {
       setError(e.message);
       setToast("Erro: " + e.message);
+      await load(); // conflito (409): mostra o estado atual
     }
   }
 
@@ -137,9 +143,9 @@ Quando pagar me manda o comprovante por aqui 🙏
                   <td><span className={"badge " + c.status}>{c.status}</span></td>
                   <td>
                     <div className="row">
-                      <button className="btn secondary" onClick={() => setStatus(c.id, "pending")}>Pendente</button>
-                      <button className="btn green" onClick={() => setStatus(c.id, "paid")}>Pago</button>
-                      <button className="btn red" onClick={() => setStatus(c.id, "canceled")}>Cancelar</button>
+                      <button className="btn secondary" disabled={!canMove(c, "pending")} onClick={() => setStatus(c, "pending")}>Pendente</button>
+                      <button className="btn green" disabled={!canMove(c, "paid")} onClick={() => setStatus(c, "paid")}>Pago</button>
+                      <button className="btn red" disabled={!canMove(c, "canceled")} onClick={() => setStatus(c, "canceled")}>Cancelar</button>
                     </div>
                   </td>
                 </tr>